@@ -1,36 +1,129 @@
 # -*- coding: utf-8 -*-
 """
 Клиент для api.exchangerate.host.
-Все запросы идут на http://api.exchangerate.host (convert и list).
-Курсы кэшируются на 5 минут, чтобы не превышать лимит запросов API.
+Все запросы идут на http://api.exchangerate.host (convert, live и list).
+Курсы кэшируются (4 минуты свежие, до 10 минут — устаревшие с фоновым обновлением),
+чтобы не превышать лимит запросов API.
 """
 
+import atexit
+import os
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from types import SimpleNamespace
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # orjson быстрее разбирает ответы API; если не установлен — stdlib json
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
 
 BASE_URL = "http://api.exchangerate.host"
+_CONVERT_URL = f"{BASE_URL}/convert"
+_LIST_URL = f"{BASE_URL}/list"
+_LIVE_URL = f"{BASE_URL}/live"
+# Таймауты запроса: (подключение, чтение) в секундах — короткие, чтобы зависший
+# запрос не держал поток обработчика Telegram
+_REQUEST_TIMEOUT = (3, 5)
+# Один повтор без учёта Retry-After (иначе urllib3 спит столько, сколько попросит сервер).
+# Худший случай запроса — две попытки по полному таймауту плюс пауза перед повтором;
+# столько же ждут потоки, пришедшие за той же парой (single-flight)
+_REQUEST_RETRIES = 1
+_RETRY_BACKOFF = 0.3
+_REQUEST_MAX_TIME = (_REQUEST_RETRIES + 1) * sum(_REQUEST_TIMEOUT) + _REQUEST_RETRIES * _RETRY_BACKOFF
+_CONVERT_MAX_WORKERS = 8
+
+# Общая сессия: keep-alive соединение к API переиспользуется между запросами.
+_SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    # Повтор при временных сбоях и ответах 5xx; 429 не повторяем — лимит за 0.3 сек. не сбросится
+    max_retries=Retry(
+        total=_REQUEST_RETRIES,
+        backoff_factor=_RETRY_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=("GET",),
+        respect_retry_after_header=False,
+    ),
+)
+_SESSION.mount("http://", _adapter)
+_SESSION.mount("https://", _adapter)
+
+# Кэш курсов: ключ (from_cur, to_cur) -> (курс за 1 единицу, время).
+# Первые 240 сек. курс свежий; до 600 сек. он отдаётся сразу, а в фоне запрашивается новый
+# (stale-while-revalidate). До часа запись хранится как запасная — её отдаём, если API
+# недоступен или вернул ошибку; старше — удаляется.
+# Размер ограничен: при переполнении вытесняется давно не использованная пара (LRU).
+_convert_cache: OrderedDict = OrderedDict()
+_CONVERT_FRESH_TTL = 240
+_CONVERT_CACHE_TTL = 600
+_CONVERT_FALLBACK_TTL = 3600
+_CONVERT_CACHE_MAXSIZE = 512
+# Кэш читается из потоков бота: доступ под блокировкой, а для каждой пары
+# в API идёт только один запрос одновременно — остальные ждут его результат.
+_cache_lock = threading.Lock()
+_inflight: dict = {}
+# Ошибки API по паре (неизвестная валюта и т.п.) кэшируются ненадолго,
+# чтобы повторный ввод той же пары не тратил лимит запросов.
+# Сетевые сбои кэшируются на несколько секунд: этого хватает, чтобы потоки, ждавшие
+# упавший запрос (single-flight), не повторили его каждый сам.
+_error_cache: OrderedDict = OrderedDict()
+_ERROR_CACHE_TTL = 60
+_REQUEST_FAILED_TTL = 5
+_ERROR_CACHE_MAXSIZE = 256
+
+# config.env ищется в первую очередь рядом с этим файлом — путь вычисляется один раз.
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+_DEFAULT_CONFIG = os.path.join(_PROJECT_DIR, "config.env")
+# Разобранный config.env: ((путь, mtime файла), env). Перечитывается только при изменении файла.
+_config_cache = None
+
+# Список валют /list: (currencies, время). TTL = 1 час.
+_currencies_cache = None
+_CURRENCIES_CACHE_TTL = 3600
+
+# Таблица курсов /live: source -> ({код: единиц валюты за 1 source}, время).
+# Один запрос даёт курсы для любых пар, поэтому TTL как у свежего курса пары.
+# Ошибки /live лежат в _error_cache под ключом ("/live", source), запрос в работе — в _inflight.
+_rate_table_cache: dict = {}
+_RATE_TABLE_TTL = _CONVERT_FRESH_TTL
+
+
+def close():
+    """Закрывает общую HTTP-сессию (вызывается автоматически при завершении процесса)."""
+    _SESSION.close()
+
 
-# Кэш курсов: ключ (from_cur, to_cur) -> (результат, время). TTL = 300 сек.
-_convert_cache: dict = {}
-_CONVERT_CACHE_TTL = 300
+atexit.register(close)
 
 
 def get_config():
     """Читает переменные из config.env в корне проекта (EXCHANGERATE_ACCESS_KEY, TELEGRAM_BOT_TOKEN)."""
-    import os
-    # Ищем config.env: рядом с этим файлом (корень проекта) или в текущей рабочей папке
-    project_dir = os.path.dirname(os.path.abspath(__file__))
-    cwd = os.getcwd()
-    for base in (project_dir, cwd):
-        config_path = os.path.join(base, "config.env")
-        if os.path.isfile(config_path):
-            break
-    else:
-        config_path = os.path.join(project_dir, "config.env")
-        raise FileNotFoundError(
-            "Файл config.env не найден. Создайте его в корне проекта (рядом с bot.py) по образцу config.example.env "
-            "и укажите EXCHANGERATE_ACCESS_KEY и TELEGRAM_BOT_TOKEN."
-        )
+    global _config_cache
+    # Ищем config.env: рядом с этим файлом (корень проекта), затем в текущей рабочей папке
+    # Один stat() в обычном случае: он же проверяет наличие файла и даёт mtime для кэша
+    config_path = _DEFAULT_CONFIG
+    try:
+        mtime = os.stat(config_path).st_mtime
+    except OSError:
+        config_path = os.path.join(os.getcwd(), "config.env")
+        try:
+            mtime = os.stat(config_path).st_mtime
+        except OSError:
+            raise FileNotFoundError(
+                "Файл config.env не найден. Создайте его в корне проекта (рядом с bot.py) по образцу config.example.env "
+                "и укажите EXCHANGERATE_ACCESS_KEY и TELEGRAM_BOT_TOKEN."
+            ) from None
+    if _config_cache is not None and _config_cache[0] == (config_path, mtime):
+        return _config_cache[1]
     env = {}
     with open(config_path, "r", encoding="utf-8") as f:
         for line in f:
@@ -43,50 +136,187 @@ def get_config():
     access_key = env.get("EXCHANGERATE_ACCESS_KEY")
     if not access_key:
         raise ValueError("В config.env не указан EXCHANGERATE_ACCESS_KEY.")
+    _config_cache = ((config_path, mtime), env)
     return env
 
 
+def _cached_rate(cache_key: tuple, now: float, max_age: float = _CONVERT_CACHE_TTL):
+    """
+    Курс из кэша для пары (from, to) не старше max_age: (курс, stale_key) или (None, None).
+    Обратная пара (to, from) тоже подходит: курс = 1 / закэшированный.
+    stale_key — ключ устаревшей записи, которую пора обновить в фоне, иначе None.
+    """
+    for key, inverse in ((cache_key, False), ((cache_key[1], cache_key[0]), True)):
+        entry = _convert_cache.get(key)
+        if entry is None:
+            continue
+        rate, cached_at = entry
+        if now - cached_at >= _CONVERT_FALLBACK_TTL:
+            # Совсем старые записи удаляем сразу, чтобы не держать их в памяти
+            del _convert_cache[key]
+            continue
+        if now - cached_at >= max_age:
+            continue
+        if inverse and not rate:
+            continue
+        _convert_cache.move_to_end(key)
+        stale_key = key if now - cached_at >= _CONVERT_FRESH_TTL else None
+        return (1.0 / rate if inverse else rate), stale_key
+    return None, None
+
+
+def _cached_error(cache_key: tuple, now: float):
+    """Недавняя ошибка API для пары (копия dict) или None."""
+    entry = _error_cache.get(cache_key)
+    if entry is None:
+        return None
+    error, expires_at = entry
+    if now >= expires_at:
+        del _error_cache[cache_key]
+        return None
+    return dict(error)
+
+
+def _store_error(cache_key: tuple, error: dict, now: float, ttl: float = _ERROR_CACHE_TTL):
+    """Сохраняет ошибку API для пары на ttl сек., вытесняя самую старую запись при переполнении."""
+    _error_cache[cache_key] = (error, now + ttl)
+    _error_cache.move_to_end(cache_key)
+    while len(_error_cache) > _ERROR_CACHE_MAXSIZE:
+        _error_cache.popitem(last=False)
+
+
+def _store_rate(cache_key: tuple, rate: float, now: float):
+    """Сохраняет курс в кэш, вытесняя самую старую пару при превышении размера."""
+    _convert_cache[cache_key] = (rate, now)
+    _convert_cache.move_to_end(cache_key)
+    while len(_convert_cache) > _CONVERT_CACHE_MAXSIZE:
+        _convert_cache.popitem(last=False)
+
+
 def convert(access_key: str, from_currency: str, to_currency: str, amount: float):
     """
     Конвертация суммы через endpoint /convert.
-    Результат для пары (from, to) кэшируется на 5 минут, чтобы не превышать лимит API.
-    Возвращает dict с ключами: success, result, from, to, amount, info (при ошибке).
+    Курс для пары (from, to) кэшируется (и используется для обратной пары), чтобы не превышать лимит API;
+    устаревший курс отдаётся сразу и обновляется в фоне.
+    Если API недоступен или вернул ошибку, а пара запрашивалась в последний час,
+    возвращается последний известный курс с пометкой stale=True.
+    Возвращает dict с ключами: success, result, from, to, amount, stale (запасной курс), info (при ошибке).
     """
     from_currency = from_currency.upper()
     to_currency = to_currency.upper()
+    result = _convert_cached(access_key, from_currency, to_currency, amount)
+    if result.get("success"):
+        return result
+    with _cache_lock:
+        rate = _cached_rate((from_currency, to_currency), time.time(), _CONVERT_FALLBACK_TTL)[0]
+    if rate is None:
+        return result
+    fallback = _rate_result(from_currency, to_currency, amount, rate)
+    fallback["stale"] = True
+    return fallback
+
+
+def _convert_cached(access_key: str, from_currency: str, to_currency: str, amount: float):
+    """convert() без запасного курса: кэш, single-flight и запрос к API."""
     cache_key = (from_currency, to_currency)
-    now = time.time()
-    if cache_key in _convert_cache:
-        cached_result, cached_at = _convert_cache[cache_key]
-        if now - cached_at < _CONVERT_CACHE_TTL and cached_result.get("success"):
-            # Возвращаем закэшированный курс, пересчитанный на amount
-            rate = cached_result["result"] / max(cached_result.get("amount", 1), 1e-9)
+    with _cache_lock:
+        now = time.time()
+        rate, stale_key = _cached_rate(cache_key, now)
+        error = _cached_error(cache_key, now) if rate is None else None
+        if rate is None and error is None:
+            event = _inflight.get(cache_key)
+            leader = event is None
+            if leader:
+                event = _inflight[cache_key] = threading.Event()
+        elif (stale_key is not None and stale_key not in _inflight
+                and _cached_error(stale_key, now) is None):
+            # Отдаём устаревший курс сразу, а новый запрашиваем в фоне.
+            # Пока ошибка обновления в кэше ошибок, лимит API на повторы не тратим
+            _inflight[stale_key] = threading.Event()
+            threading.Thread(
+                target=_refresh_rate, args=(access_key, stale_key), daemon=True,
+            ).start()
+    if rate is not None:
+        return _rate_result(from_currency, to_currency, amount, rate)
+    if error is not None:
+        return error
+
+    if not leader:
+        # Запрос по этой паре уже выполняется в другом потоке — ждём его
+        if not event.wait(_REQUEST_MAX_TIME):
+            # Запрос лидера завис дольше худшего случая — свой не отправляем, поток не держим
             return {
-                "success": True,
-                "from": from_currency,
-                "to": to_currency,
-                "amount": amount,
-                "result": amount * rate,
+                "success": False,
+                "error": "request_failed",
+                "info": "API не ответил вовремя.",
             }
+        with _cache_lock:
+            now = time.time()
+            rate = _cached_rate(cache_key, now)[0]
+            error = _cached_error(cache_key, now) if rate is None else None
+        if rate is not None:
+            return _rate_result(from_currency, to_currency, amount, rate)
+        if error is not None:
+            return error
+        return _request_convert(access_key, from_currency, to_currency, amount)
+
+    try:
+        return _request_convert(access_key, from_currency, to_currency, amount)
+    finally:
+        with _cache_lock:
+            _inflight.pop(cache_key, None)
+        event.set()
+
 
-    url = f"{BASE_URL}/convert"
-    params = {
-        "access_key": access_key,
+def _refresh_rate(access_key: str, cache_key: tuple):
+    """Фоновое обновление устаревшего курса; событие в _inflight создаёт вызывающий код."""
+    try:
+        _request_convert(access_key, cache_key[0], cache_key[1], 1.0)
+    finally:
+        with _cache_lock:
+            event = _inflight.pop(cache_key, None)
+        if event is not None:
+            event.set()
+
+
+def _rate_result(from_currency: str, to_currency: str, amount: float, rate: float):
+    """Ответ convert() по известному курсу, без обращения к API."""
+    return {
+        "success": True,
         "from": from_currency,
         "to": to_currency,
         "amount": amount,
+        "result": amount * rate,
     }
+
+
+def _request_convert(access_key: str, from_currency: str, to_currency: str, amount: float):
+    """Запрос к /convert; при успехе курс сохраняется в кэш, ошибка — в кэш ошибок."""
+    now = time.time()
+    params = (
+        ("access_key", access_key),
+        ("from", from_currency),
+        ("to", to_currency),
+        ("amount", amount),
+    )
     try:
-        r = requests.get(url, params=params, timeout=10)
-        data = r.json()
+        r = _SESSION.get(_CONVERT_URL, params=params, timeout=_REQUEST_TIMEOUT)
+        data = _json_loads(r.content)
     except requests.RequestException as e:
-        return {
+        error = {
             "success": False,
             "error": "request_failed",
             "info": f"Не удалось связаться с API: {e!s}",
         }
     except ValueError as e:
-        return {"success": False, "error": "invalid_response", "info": str(e)}
+        error = {"success": False, "error": "invalid_response", "info": str(e)}
+    else:
+        error = None
+    if error is not None:
+        # Время сбоя, а не начала запроса: запрос мог идти дольше _REQUEST_FAILED_TTL
+        with _cache_lock:
+            _store_error((from_currency, to_currency), error, time.time(), _REQUEST_FAILED_TTL)
+        return dict(error)
 
     if not data.get("success", False):
         err = data.get("error", {})
@@ -96,34 +326,166 @@ def convert(access_key: str, from_currency: str, to_currency: str, amount: float
         else:
             code = err
             info = data.get("info", "Ошибка API.")
-        return {
+        error = {
             "success": False,
             "error": "api_error",
             "code": code,
             "info": info,
         }
+        with _cache_lock:
+            _store_error((from_currency, to_currency), error, now)
+        return dict(error)
 
-    result = {
+    query = data.get("query") or {}
+    result = float(data.get("result", 0))
+    api_amount = float(query.get("amount", amount))
+    if api_amount:
+        with _cache_lock:
+            _store_rate((from_currency, to_currency), result / api_amount, now)
+    return {
         "success": True,
-        "from": data.get("query", {}).get("from", from_currency),
-        "to": data.get("query", {}).get("to", to_currency),
-        "amount": float(data.get("query", {}).get("amount", amount)),
-        "result": float(data.get("result", 0)),
+        "from": query.get("from", from_currency),
+        "to": query.get("to", to_currency),
+        "amount": api_amount,
+        "result": result,
     }
-    _convert_cache[cache_key] = (result, now)
-    return result
+
+
+def convert_many(access_key: str, requests_list: list):
+    """
+    Несколько конвертаций параллельно: requests_list — список (from, to, amount).
+    Запросы выполняются в пуле потоков поверх общей сессии, поэтому ожидание
+    ответов API перекрывается. Возвращает список результатов convert() в том же порядке.
+    """
+    if len(requests_list) <= 1:
+        return [convert(access_key, *item) for item in requests_list]
+    with ThreadPoolExecutor(max_workers=min(len(requests_list), _CONVERT_MAX_WORKERS)) as pool:
+        return list(pool.map(lambda item: convert(access_key, *item), requests_list))
+
+
+def get_rate_table(access_key: str, source: str = "USD"):
+    """
+    Курсы всех валют к source одним запросом через endpoint /live (кэшируется).
+    Возвращает dict: success, source, rates (dict код -> единиц валюты за 1 source),
+    fetched_at (время получения таблицы) или info при ошибке.
+    """
+    source = source.upper()
+    cache_key = ("/live", source)
+    with _cache_lock:
+        result = _cached_rate_table(source, time.time())
+        if result is None:
+            event = _inflight.get(cache_key)
+            leader = event is None
+            if leader:
+                event = _inflight[cache_key] = threading.Event()
+    if result is not None:
+        return result
+
+    if not leader:
+        # Таблицу уже запрашивает другой поток — ждём его результат
+        event.wait(_REQUEST_MAX_TIME)
+        with _cache_lock:
+            result = _cached_rate_table(source, time.time())
+        if result is not None:
+            return result
+        return _request_rate_table(access_key, source)
+
+    try:
+        return _request_rate_table(access_key, source)
+    finally:
+        with _cache_lock:
+            _inflight.pop(cache_key, None)
+        event.set()
+
+
+def _cached_rate_table(source: str, now: float):
+    """Свежая таблица или недавняя ошибка /live в формате get_rate_table(); иначе None. Под _cache_lock."""
+    entry = _rate_table_cache.get(source)
+    if entry is not None and now - entry[1] < _RATE_TABLE_TTL:
+        return {"success": True, "source": source, "rates": entry[0], "fetched_at": entry[1]}
+    return _cached_error(("/live", source), now)
+
+
+def _request_rate_table(access_key: str, source: str):
+    """Запрос к /live; таблица сохраняется в кэш, любая ошибка — ненадолго в кэш ошибок."""
+    now = time.time()
+    try:
+        r = _SESSION.get(
+            _LIVE_URL, params=(("access_key", access_key), ("source", source)), timeout=_REQUEST_TIMEOUT,
+        )
+        data = _json_loads(r.content)
+    except requests.RequestException as e:
+        error = {
+            "success": False,
+            "error": "request_failed",
+            "info": f"Не удалось связаться с API: {e!s}",
+        }
+    except ValueError as e:
+        error = {"success": False, "error": "invalid_response", "info": str(e)}
+    else:
+        error = None
+        if not data.get("success", False):
+            err = data.get("error", {})
+            if isinstance(err, dict):
+                info = err.get("info", "Неизвестная ошибка API.")
+            else:
+                info = data.get("info", "Ошибка API.")
+            error = {"success": False, "error": "api_error", "info": info}
+    if error is not None:
+        # Кэшируем и сетевые ошибки: после отказа /live вызывающий код всё равно идёт
+        # в convert(), и повторять запрос таблицы на каждое нажатие незачем
+        with _cache_lock:
+            _store_error(("/live", source), error, now)
+        return dict(error)
+
+    # Ключи quotes имеют вид "USDRUB": отрезаем код source
+    rates = {source: 1.0}
+    for pair, value in (data.get("quotes") or {}).items():
+        if pair.startswith(source) and value:
+            rates[pair[len(source):]] = float(value)
+    with _cache_lock:
+        _rate_table_cache[source] = (rates, now)
+    return {"success": True, "source": source, "rates": rates, "fetched_at": now}
+
+
+def convert_from_table(access_key: str, from_currency: str, to_currency: str, amount: float):
+    """
+    Конвертация по таблице /live: курс любой пары считается локально из одного запроса.
+    Полученный курс пары попадает в общий кэш convert(). Если таблица недоступна
+    или в ней нет валюты — обычный convert(). Формат ответа как у convert().
+    """
+    from_currency = from_currency.upper()
+    to_currency = to_currency.upper()
+    # Свежий курс пары уже есть — таблица не нужна
+    with _cache_lock:
+        rate = _cached_rate((from_currency, to_currency), time.time(), _CONVERT_FRESH_TTL)[0]
+    if rate is not None:
+        return _rate_result(from_currency, to_currency, amount, rate)
+    table = get_rate_table(access_key)
+    rates = table.get("rates") or {}
+    if table.get("success") and from_currency in rates and to_currency in rates:
+        rate = rates[to_currency] / rates[from_currency]
+        # Возраст курса пары — это возраст таблицы, а не момент расчёта
+        with _cache_lock:
+            _store_rate((from_currency, to_currency), rate, table["fetched_at"])
+        return _rate_result(from_currency, to_currency, amount, rate)
+    return convert(access_key, from_currency, to_currency, amount)
 
 
 def get_currencies_list(access_key: str):
     """
     Получить список поддерживаемых валют через endpoint /list.
+    Успешный ответ кэшируется на час — список валют меняется редко.
     Возвращает dict: success, currencies (dict код -> название) или info при ошибке.
     """
-    url = f"{BASE_URL}/list"
-    params = {"access_key": access_key}
+    global _currencies_cache
+    with _cache_lock:
+        if _currencies_cache is not None and time.time() - _currencies_cache[1] < _CURRENCIES_CACHE_TTL:
+            return {"success": True, "currencies": _currencies_cache[0]}
+
     try:
-        r = requests.get(url, params=params, timeout=10)
-        data = r.json()
+        r = _SESSION.get(_LIST_URL, params=(("access_key", access_key),), timeout=_REQUEST_TIMEOUT)
+        data = _json_loads(r.content)
     except requests.RequestException as e:
         return {
             "success": False,
@@ -141,23 +503,49 @@ def get_currencies_list(access_key: str):
             info = data.get("info", "Ошибка API.")
         return {"success": False, "error": "api_error", "info": info}
 
+    currencies = data.get("currencies", {})
+    with _cache_lock:
+        _currencies_cache = (currencies, time.time())
     return {
         "success": True,
-        "currencies": data.get("currencies", {}),
+        "currencies": currencies,
     }
 
 
 def check_currencies_available(access_key: str, from_currency: str, to_currency: str):
     """
-    Проверить, что обе валюты поддерживаются API (через convert с amount=1).
+    Проверить, что обе валюты поддерживаются API.
+    Проверка идёт по закэшированному списку /list; если он недоступен — через convert с amount=1.
     Возвращает (ok: bool, message: str).
     """
     from_currency = from_currency.upper()
     to_currency = to_currency.upper()
     if from_currency == to_currency:
         return False, "Валюта отправления и назначения не должны совпадать."
+    listed = get_currencies_list(access_key)
+    if listed.get("success") and listed.get("currencies"):
+        currencies = listed["currencies"]
+        for cur in (from_currency, to_currency):
+            if cur not in currencies:
+                return False, f"Валюта {cur} не поддерживается API."
+        return True, "OK"
     result = convert(access_key, from_currency, to_currency, 1.0)
     if not result.get("success"):
         info = result.get("info", "Валюта недоступна в API.")
         return False, info
     return True, "OK"
+
+
+def make_client(access_key: str):
+    """
+    Клиент с заранее подставленным access_key: ключ читается из конфигурации один раз при старте,
+    дальше вызовы api.convert(from, to, amount) и т.п. не требуют передавать его заново.
+    """
+    return SimpleNamespace(
+        convert=partial(convert, access_key),
+        convert_many=partial(convert_many, access_key),
+        convert_from_table=partial(convert_from_table, access_key),
+        get_rate_table=partial(get_rate_table, access_key),
+        get_currencies_list=partial(get_currencies_list, access_key),
+        check_currencies_available=partial(check_currencies_available, access_key),
+    )
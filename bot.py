@@ -4,16 +4,30 @@ Telegram-бот «Мини-кошелёк для путешественника
 API: api.exchangerate.host (только он). Данные в SQLite.
 """
 
+import hmac
+import io
 import re
 import logging
+import secrets
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import Optional
 
+import requests
 import telebot
-from telebot import types
+from requests.adapters import HTTPAdapter
+from telebot import apihelper, types
+from telebot.apihelper import ApiException
 
-from api_client import get_config, convert
+from api_client import get_config, make_client
 from current_api import country_to_currency
 import db
+import state
+import trip_cache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,13 +39,116 @@ try:
     ACCESS_KEY = config["EXCHANGERATE_ACCESS_KEY"]
 except Exception as e:
     logger.error("Конфигурация: %s", e)
+    config = {}
     BOT_TOKEN = ""
     ACCESS_KEY = ""
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# Webhook (необязательно): если задан TELEGRAM_WEBHOOK_URL, обновления принимает HTTP-сервер,
+# иначе бот работает через long polling.
+WEBHOOK_URL = config.get("TELEGRAM_WEBHOOK_URL", "")
+# Секрет обязателен: без него любой, кто достучится до порта, подделает обновление от имени
+# пользователя. Если он не задан, генерируется случайный на время работы бота.
+WEBHOOK_SECRET = config.get("TELEGRAM_WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_HOST = config.get("TELEGRAM_WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(config.get("TELEGRAM_WEBHOOK_PORT") or 8443)
+POLLING_TIMEOUT = 50
+
+# Обработчики выполняются в общем пуле из BOT_NUM_THREADS потоков: пока один ждёт ответа
+# Telegram или API курсов, обновления других чатов обрабатываются параллельно. У каждого чата
+# своя очередь, и его обновления обрабатываются строго по одному — шаги диалога не
+# перемешиваются, а медленный чат задерживает только себя.
+BOT_NUM_THREADS = 8
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+api = make_client(ACCESS_KEY)
+
+# Одна keep-alive сессия к api.telegram.org вместо отдельной в каждом потоке: TLS-соединения
+# переиспользуются потоками чатов, отправки и polling. Пул рассчитан на все эти потоки.
+_telegram_session = requests.Session()
+_telegram_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=32)
+_telegram_session.mount("https://", _telegram_adapter)
+apihelper.session = _telegram_session
+
+_chat_pool = ThreadPoolExecutor(max_workers=BOT_NUM_THREADS, thread_name_prefix="chat")
+# chat_id -> очередь ожидающих обновлений; запись есть, пока обновление чата обрабатывается
+_chat_queues: dict = {}
+_chat_queues_lock = threading.Lock()
+_process_new_updates = bot.process_new_updates
+
+
+def _update_chat_id(update) -> int:
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        cq = update.callback_query
+        return cq.message.chat.id if cq.message else cq.from_user.id
+    return 0
+
+
+def _process_update(update):
+    try:
+        _process_new_updates([update])
+    except Exception:
+        logger.exception("Ошибка при обработке обновления %s", update.update_id)
+
+
+def _enqueue_update(chat_id: int, update):
+    with _chat_queues_lock:
+        queue = _chat_queues.get(chat_id)
+        if queue is not None:
+            # Чат занят: обновление заберёт текущий обработчик этого чата
+            queue.append(update)
+            return
+        _chat_queues[chat_id] = deque()
+    _chat_pool.submit(_run_chat_update, chat_id, update)
+
+
+def _run_chat_update(chat_id: int, update):
+    """Обрабатывает обновление и ставит в пул следующее из очереди чата."""
+    _process_update(update)
+    with _chat_queues_lock:
+        queue = _chat_queues[chat_id]
+        if not queue:
+            del _chat_queues[chat_id]
+            return
+        update = queue.popleft()
+    # Следующее обновление — в конец очереди пула, чтобы потоки доставались всем чатам по очереди
+    _chat_pool.submit(_run_chat_update, chat_id, update)
+
+
+def dispatch_updates(updates):
+    """Раскладывает обновления по очередям чатов (вызывается polling-циклом и webhook)."""
+    # Смещение getUpdates обновляем сразу, иначе polling получит те же обновления повторно
+    for update in updates:
+        if update.update_id > bot.last_update_id:
+            bot.last_update_id = update.update_id
+    for update in updates:
+        _enqueue_update(_update_chat_id(update), update)
+
+
+bot.process_new_updates = dispatch_updates
+
+# Исходящие сообщения отправляются в фоне: обработчик не ждёт ответа Telegram и сразу
+# берётся за следующее обновление. Сообщения одного чата идут через один поток — порядок сохраняется.
+SEND_NUM_THREADS = 4
+_send_workers = [
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"send{i}") for i in range(SEND_NUM_THREADS)
+]
+
+
+def _send_now(chat_id: int, text: str, kwargs: dict):
+    try:
+        bot.send_message(chat_id, text, **kwargs)
+    except Exception:
+        logger.exception("Не удалось отправить сообщение в чат %s", chat_id)
+
+
+def send_message(chat_id: int, text: str, **kwargs):
+    """Ставит bot.send_message в очередь потока отправки этого чата."""
+    _send_workers[chat_id % SEND_NUM_THREADS].submit(_send_now, chat_id, text, kwargs)
 
 # --- Inline keyboard: главное меню ---
-def main_menu_markup():
+# Статичные клавиатуры не зависят от пользователя — строятся один раз при импорте.
+def _build_main_menu_markup():
     return types.InlineKeyboardMarkup(row_width=1).add(
         types.InlineKeyboardButton("Создать новое путешествие", callback_data="menu_newtrip"),
         types.InlineKeyboardButton("Мои путешествия", callback_data="menu_trips"),
@@ -42,14 +159,28 @@ def main_menu_markup():
     )
 
 
+_MAIN_MENU_MARKUP = _build_main_menu_markup()
+
+
+def main_menu_markup():
+    return _MAIN_MENU_MARKUP
+
+
 def trips_list_markup(trips: list, prefix: str = "switch_"):
+    key = tuple((t["id"], t["name"], t["dest_currency"]) for t in trips)
+    return _trips_list_markup(key, prefix)
+
+
+@lru_cache(maxsize=1024)
+def _trips_list_markup(trips: tuple, prefix: str):
+    """Клавиатура списка поездок; кэшируется по (id, name, dest_currency) и префиксу."""
     kb = types.InlineKeyboardMarkup(row_width=1)
-    for t in trips:
+    for trip_id, name, dest_currency in trips:
         kb.add(types.InlineKeyboardButton(
-            f"{t['name']} ({t['dest_currency']})",
-            callback_data=f"{prefix}{t['id']}",
+            f"{name} ({dest_currency})",
+            callback_data=f"{prefix}{trip_id}",
         ))
-    kb.add(types.InlineKeyboardButton("← Назад", callback_data="menu_main"))
+    kb.add(types.InlineKeyboardButton("← Назад", callback_data="menu_back"))
     return kb
 
 
@@ -61,12 +192,19 @@ def trip_confirm_delete_markup(trip_id: int):
     )
 
 
-def back_to_main_markup():
+def _build_back_to_main_markup():
     return types.InlineKeyboardMarkup().add(
         types.InlineKeyboardButton("← В главное меню", callback_data="menu_main"),
     )
 
 
+_BACK_TO_MAIN_MARKUP = _build_back_to_main_markup()
+
+
+def back_to_main_markup():
+    return _BACK_TO_MAIN_MARKUP
+
+
 # --- Кнопки быстрого доступа (постоянное меню под полем ввода) ---
 MENU_BTN_NEWTRIP = "Создать путешествие"
 MENU_BTN_TRIPS = "Мои путешествия"
@@ -76,8 +214,7 @@ MENU_BTN_SETRATE = "Изменить курс"
 MENU_BTN_DELETETRIP = "Удалить путешествие"
 
 
-def reply_keyboard_menu():
-    """Клавиатура меню для быстрого доступа (всегда видна под полем ввода)."""
+def _build_reply_keyboard_menu():
     return types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False).add(
         types.KeyboardButton(MENU_BTN_NEWTRIP),
         types.KeyboardButton(MENU_BTN_TRIPS),
@@ -90,69 +227,116 @@ def reply_keyboard_menu():
     )
 
 
-def yes_no_markup(amount_dest: float, amount_home: float, dest_cur: str, home_cur: str):
-    # callback: expense_yes_<trip_id>_<amount_dest>_<amount_home>
-    return types.InlineKeyboardMarkup(row_width=2).add(
-        types.InlineKeyboardButton("✅ Да", callback_data=f"expense_yes_{amount_dest}_{amount_home}"),
-        types.InlineKeyboardButton("❌ Нет", callback_data="expense_no"),
-    )
+_REPLY_KEYBOARD_MENU = _build_reply_keyboard_menu()
+
+
+def reply_keyboard_menu():
+    """Клавиатура меню для быстрого доступа (всегда видна под полем ввода)."""
+    return _REPLY_KEYBOARD_MENU
 
 
 # --- Текст главного меню ---
+MAIN_MENU_TEXT = (
+    "Главное меню. Выберите действие:\n\n"
+    "• Создать новое путешествие — добавить поездку с валютной парой и курсом.\n"
+    "• Мои путешествия — переключиться между поездками.\n"
+    "• Баланс — посмотреть остаток по активному путешествию.\n"
+    "• История расходов — список трат.\n"
+    "• Изменить курс — задать курс вручную для выбранной поездки.\n"
+    "• Удалить путешествие — удалить поездку и все её расходы."
+)
+
+
 def main_menu_text():
-    return (
-        "Главное меню. Выберите действие:\n\n"
-        "• Создать новое путешествие — добавить поездку с валютной парой и курсом.\n"
-        "• Мои путешествия — переключиться между поездками.\n"
-        "• Баланс — посмотреть остаток по активному путешествию.\n"
-        "• История расходов — список трат.\n"
-        "• Изменить курс — задать курс вручную для выбранной поездки.\n"
-        "• Удалить путешествие — удалить поездку и все её расходы."
-    )
+    return MAIN_MENU_TEXT
 
 
 def send_main_menu(chat_id: int, text: Optional[str] = None):
-    bot.send_message(
+    send_message(
         chat_id,
         text or main_menu_text(),
         reply_markup=main_menu_markup(),
     )
 
 
-# --- Обработка числа как расхода ---
-def is_number_message(text: str) -> bool:
-    if not text or not text.strip():
-        return False
-    # Допускаем число с точкой/запятой и опционально пробелами
-    s = text.strip().replace(",", ".")
-    return bool(re.match(r"^-?\d+\.?\d*$", s))
+def show_main_menu_in_place(c, text: Optional[str] = None):
+    """Заменяет сообщение с нажатой кнопкой главным меню (один запрос); если нельзя — отправляет новое.
+    Только для навигационных сообщений (списки поездок, подтверждение удаления): баланс или историю
+    так затирать нельзя."""
+    try:
+        bot.edit_message_text(
+            text or main_menu_text(),
+            c.message.chat.id,
+            c.message.message_id,
+            reply_markup=main_menu_markup(),
+        )
+    except ApiException:
+        send_main_menu(c.message.chat.id, text)
+
+
+# --- История расходов ---
+# Лимит Telegram — 4096 символов на сообщение; длинная история уходит несколькими сообщениями
+HISTORY_CHUNK_CHARS = 3500
 
 
-def parse_amount(text: str) -> float:
-    s = text.strip().replace(",", ".")
-    return float(s)
+def send_history(chat_id: int, header: str, trip, expenses):
+    """Отправляет историю расходов частями; кнопка «В главное меню» — у последней части."""
+    dest_cur, home_cur = trip["dest_currency"], trip["home_currency"]
+    buf = io.StringIO()
+    buf.write(header)
+    buf.write("\n")
+    for e in expenses:
+        line = db.format_expense_line(e, dest_cur, home_cur)
+        if buf.tell() + len(line) + 1 > HISTORY_CHUNK_CHARS:
+            send_message(chat_id, buf.getvalue())
+            buf = io.StringIO()
+        if buf.tell():
+            buf.write("\n")
+        buf.write(line)
+    send_message(chat_id, buf.getvalue(), reply_markup=back_to_main_markup())
+
+
+# --- Обработка числа как расхода ---
+# Число с точкой или запятой, опционально с пробелами вокруг: проверка и разбор за один проход
+_AMOUNT_RE = re.compile(r"\s*(-?\d+(?:[.,]\d*)?)\s*")
+_NUM_FIRST_CHARS = frozenset("-0123456789")
+
+
+def try_parse_amount(text: str) -> Optional[float]:
+    """Сумма из сообщения или None, если это не число."""
+    if not text:
+        return None
+    # Большинство сообщений — не числа: отсекаем по первому символу, не создавая новых строк
+    first = text[0]
+    if first not in _NUM_FIRST_CHARS and not first.isspace():
+        return None
+    m = _AMOUNT_RE.fullmatch(text)
+    if m is None:
+        return None
+    s = m.group(1)
+    return float(s.replace(",", ".") if "," in s else s)
 
 
 # --- Создание путешествия (FSM) ---
 def start_new_trip_flow(chat_id: int, user_id: int):
-    db.set_user_state(user_id, "newtrip_country_from", None)
-    bot.send_message(
+    state.set_user_state(user_id, "newtrip_country_from", None)
+    send_message(
         chat_id,
         "Введите страну отправления (домашнюю валюту), например: Россия, США, Китай.",
     )
 
 
-def handle_newtrip_country_from(message, user_id: int):
+def handle_newtrip_country_from(message, user_id: int, state_data: str):
     country = message.text.strip()
     cur = country_to_currency(country)
     if not cur:
-        bot.send_message(
+        send_message(
             message.chat.id,
             "Не удалось определить валюту по этой стране. Введите страну ещё раз или код валюты (например RUB, USD).",
         )
         return
-    db.set_user_state(user_id, "newtrip_country_to", cur)
-    bot.send_message(
+    state.set_user_state(user_id, "newtrip_country_to", cur)
+    send_message(
         message.chat.id,
         f"Валюта отправления: {cur}. Теперь введите страну назначения (валюту поездки), например: Китай, Таиланд.",
     )
@@ -167,17 +351,17 @@ def handle_newtrip_country_to(message, user_id: int, state_data: str):
         if len(country) == 3 and country.isalpha():
             cur = country.upper()
         else:
-            bot.send_message(
+            send_message(
                 message.chat.id,
                 "Не удалось определить валюту. Введите страну или код валюты (3 буквы).",
             )
             return
     if cur == home_currency:
-        bot.send_message(message.chat.id, "Валюта назначения должна отличаться от домашней. Введите другую страну.")
+        send_message(message.chat.id, "Валюта назначения должна отличаться от домашней. Введите другую страну.")
         return
     # API не вызываем здесь — только по кнопке «Получить из API». Так не превышаем лимит и не показываем ошибку.
-    db.set_user_state(user_id, "newtrip_choose_rate_source", f"{home_currency}|{cur}|{country}")
-    bot.send_message(
+    state.set_user_state(user_id, "newtrip_choose_rate_source", f"{home_currency}|{cur}|{country}")
+    send_message(
         message.chat.id,
         f"Пара валют: {home_currency} → {cur}. Как задать курс?\n\n"
         "Рекомендуем «Ввести вручную» — так не будет ошибок лимита API.",
@@ -191,70 +375,123 @@ def handle_newtrip_country_to(message, user_id: int, state_data: str):
 def handle_newtrip_initial_sum(message, user_id: int, state_data: str):
     parts = state_data.split("|", 3)
     if len(parts) < 4:
-        db.clear_state(user_id)
+        state.clear_state(user_id)
         send_main_menu(message.chat.id, "Что-то пошло не так. Начните создание поездки заново.")
         return
     home_cur, dest_cur, rate_str = parts[0], parts[1], float(parts[2])
     name = parts[3] if len(parts) > 3 else dest_cur
-    if not is_number_message(message.text) or parse_amount(message.text) <= 0:
-        bot.send_message(message.chat.id, "Введите положительное число — сумму в валюте отправления (домашней).")
+    amount_home = try_parse_amount(message.text)
+    if amount_home is None or amount_home <= 0:
+        send_message(message.chat.id, "Введите положительное число — сумму в валюте отправления (домашней).")
         return
-    amount_home = parse_amount(message.text)
     # Курс: домашняя за 1 валюту поездки. Конвертируем: сумма в поездке = домашняя / курс
     amount_dest = amount_home / float(rate_str)
-    trip_id = db.create_trip(user_id, name, home_cur, dest_cur, float(rate_str), amount_home, amount_dest)
-    db.clear_state(user_id)
-    trip = db.get_trip(trip_id, user_id)
-    bot.send_message(
+    trip_id = trip_cache.create_trip(user_id, name, home_cur, dest_cur, float(rate_str), amount_home, amount_dest)
+    state.clear_state(user_id)
+    trip = trip_cache.get_trip(trip_id, user_id)
+    send_message(
         message.chat.id,
         f"Путешествие «{name}» создано.\n{db.format_balance(trip)}\n\nТеперь можно вводить суммы расходов в {dest_cur} — бот будет пересчитывать в {home_cur} и предлагать учесть трату.",
         reply_markup=main_menu_markup(),
     )
 
 
+def handle_newtrip_manual_rate(message, user_id: int, state_data: str):
+    chat_id = message.chat.id
+    # Ввод курса вручную: сколько валюты назначения за 1 домашнюю -> храним (домашняя за 1 назначения) = 1/ввод
+    manual_dest_per_home = try_parse_amount(message.text)
+    if manual_dest_per_home is None or manual_dest_per_home <= 0:
+        send_message(chat_id, "Введите положительное число — курс (сколько валюты назначения за 1 единицу домашней).")
+        return
+    rate = 1.0 / manual_dest_per_home
+    parts = state_data.split("|", 2)
+    if len(parts) < 2:
+        state.clear_state(user_id)
+        send_main_menu(chat_id, "Ошибка. Начните создание заново.")
+        return
+    home_cur, dest_cur = parts[0], parts[1]
+    name = parts[2].strip() if len(parts) > 2 and parts[2] else dest_cur
+    state.set_user_state(user_id, "newtrip_initial_sum", f"{home_cur}|{dest_cur}|{rate}|{name}")
+    send_message(chat_id, f"Курс принят: 1 {home_cur} = {rate} {dest_cur}. Введите начальную сумму в {home_cur}:")
+
+
+def handle_setrate_trip(message, user_id: int, state_data: str):
+    chat_id = message.chat.id
+    new_rate = try_parse_amount(message.text)
+    if new_rate is None or new_rate <= 0:
+        send_message(chat_id, "Введите положительное число — новый курс.")
+        return
+    try:
+        trip_id = int(state_data)
+    except ValueError:
+        state.clear_state(user_id)
+        send_main_menu(chat_id)
+        return
+    trip = trip_cache.get_trip(trip_id, user_id)
+    if not trip:
+        state.clear_state(user_id)
+        send_message(chat_id, "Путешествие не найдено.", reply_markup=main_menu_markup())
+        return
+    trip_cache.update_trip_rate(trip_id, user_id, new_rate)
+    state.clear_state(user_id)
+    send_message(chat_id, f"Курс обновлён: 1 {trip['home_currency']} = {new_rate} {trip['dest_currency']}.", reply_markup=main_menu_markup())
+
+
+# Состояние FSM -> обработчик(message, user_id, state_data)
+_STATE_HANDLERS = {
+    "newtrip_country_from": handle_newtrip_country_from,
+    "newtrip_country_to": handle_newtrip_country_to,
+    "newtrip_initial_sum": handle_newtrip_initial_sum,
+    "newtrip_manual_rate": handle_newtrip_manual_rate,
+    "setrate_trip": handle_setrate_trip,
+}
+
+
 # --- Callback: меню и действия ---
-@bot.callback_query_handler(func=lambda c: c.data == "menu_main")
 def cb_menu_main(c):
+    """«В главное меню» под балансом, историей и т.п.: текст сообщения оставляем, убираем только кнопку."""
     bot.answer_callback_query(c.id)
     send_main_menu(c.message.chat.id)
-
     try:
         bot.edit_message_reply_markup(c.message.chat.id, c.message.message_id, reply_markup=None)
-    except Exception:
+    except ApiException:
         pass
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "menu_newtrip")
+def cb_menu_back(c):
+    """«Назад» из списка поездок: список заменяется главным меню."""
+    bot.answer_callback_query(c.id)
+    show_main_menu_in_place(c)
+
+
 def cb_menu_newtrip(c):
     bot.answer_callback_query(c.id)
     start_new_trip_flow(c.message.chat.id, c.from_user.id)
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "menu_trips")
 def cb_menu_trips(c):
     bot.answer_callback_query(c.id)
     user_id = c.from_user.id
     trips = db.get_user_trips(user_id)
     if not trips:
-        bot.send_message(
+        send_message(
             c.message.chat.id,
             "У вас пока нет путешествий. Создайте первое — кнопка «Создать новое путешествие».",
             reply_markup=back_to_main_markup(),
         )
         return
     lines = ["Выберите путешествие для переключения:"]
-    active_id = db.get_active_trip_id(user_id)
+    active_id = trip_cache.get_active_trip_id(user_id)
     for t in trips:
         mark = " ✓" if t["id"] == active_id else ""
         lines.append(f"• {t['name']} ({t['dest_currency']}){mark}")
-    bot.send_message(
+    send_message(
         c.message.chat.id,
         "\n".join(lines),
         reply_markup=trips_list_markup(trips, "switch_"),
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("switch_"))
 def cb_switch_trip(c):
     bot.answer_callback_query(c.id)
     try:
@@ -262,95 +499,84 @@ def cb_switch_trip(c):
     except ValueError:
         return
     user_id = c.from_user.id
-    trip = db.get_trip(trip_id, user_id)
+    trip = trip_cache.get_trip(trip_id, user_id)
     if not trip:
-        bot.send_message(c.message.chat.id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
+        send_message(c.message.chat.id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
         return
-    db.set_active_trip(user_id, trip_id)
-    bot.send_message(
+    trip_cache.set_active_trip(user_id, trip_id)
+    send_message(
         c.message.chat.id,
         f"Активное путешествие: «{trip['name']}» ({trip['dest_currency']}).\n{db.format_balance(trip)}",
         reply_markup=back_to_main_markup(),
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "menu_balance")
 def cb_menu_balance(c):
     bot.answer_callback_query(c.id)
     user_id = c.from_user.id
-    trip_id = db.get_active_trip_id(user_id)
+    trip_id = trip_cache.get_active_trip_id(user_id)
     if not trip_id:
-        bot.send_message(
+        send_message(
             c.message.chat.id,
             "Нет активного путешествия. Выберите или создайте поездку в разделе «Мои путешествия».",
             reply_markup=back_to_main_markup(),
         )
         return
-    trip = db.get_trip(trip_id, user_id)
+    trip = trip_cache.get_trip(trip_id, user_id)
     if not trip:
-        bot.send_message(c.message.chat.id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
+        send_message(c.message.chat.id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
         return
-    bot.send_message(
+    send_message(
         c.message.chat.id,
         f"«{trip['name']}»\n{db.format_balance(trip)}",
         reply_markup=back_to_main_markup(),
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "menu_history")
 def cb_menu_history(c):
     bot.answer_callback_query(c.id)
     user_id = c.from_user.id
-    trip_id = db.get_active_trip_id(user_id)
+    trip_id = trip_cache.get_active_trip_id(user_id)
     if not trip_id:
-        bot.send_message(
+        send_message(
             c.message.chat.id,
             "Нет активного путешествия. Выберите поездку в «Мои путешествия».",
             reply_markup=back_to_main_markup(),
         )
         return
-    trip = db.get_trip(trip_id, user_id)
+    trip = trip_cache.get_trip(trip_id, user_id)
     if not trip:
-        bot.send_message(c.message.chat.id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
+        send_message(c.message.chat.id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
         return
     expenses = db.get_expenses(trip_id, user_id)
     if not expenses:
-        bot.send_message(
+        send_message(
             c.message.chat.id,
             f"По путешествию «{trip['name']}» расходов пока нет.",
             reply_markup=back_to_main_markup(),
         )
         return
-    lines = [f"История расходов: «{trip['name']}»", ""]
-    for e in expenses:
-        lines.append(db.format_expense_line(e, trip["dest_currency"], trip["home_currency"]))
-    bot.send_message(
-        c.message.chat.id,
-        "\n".join(lines),
-        reply_markup=back_to_main_markup(),
-    )
+    send_history(c.message.chat.id, f"История расходов: «{trip['name']}»", trip, expenses)
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "menu_setrate")
 def cb_menu_setrate(c):
     bot.answer_callback_query(c.id)
     user_id = c.from_user.id
     trips = db.get_user_trips(user_id)
     if not trips:
-        bot.send_message(
+        send_message(
             c.message.chat.id,
             "Нет путешествий. Сначала создайте поездку.",
             reply_markup=back_to_main_markup(),
         )
         return
-    bot.send_message(
+    send_message(
         c.message.chat.id,
         "Выберите путешествие, для которого изменить курс:",
         reply_markup=trips_list_markup(trips, "setrate_"),
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("setrate_"))
 def cb_setrate_choose(c):
     bot.answer_callback_query(c.id)
     try:
@@ -358,38 +584,36 @@ def cb_setrate_choose(c):
     except ValueError:
         return
     user_id = c.from_user.id
-    trip = db.get_trip(trip_id, user_id)
+    trip = trip_cache.get_trip(trip_id, user_id)
     if not trip:
-        bot.send_message(c.message.chat.id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
+        send_message(c.message.chat.id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
         return
-    db.set_user_state(user_id, "setrate_trip", str(trip_id))
-    bot.send_message(
+    state.set_user_state(user_id, "setrate_trip", str(trip_id))
+    send_message(
         c.message.chat.id,
         f"Текущий курс для «{trip['name']}»: 1 {trip['dest_currency']} = {trip['rate']} {trip['home_currency']}. Введите новый курс: сколько {trip['home_currency']} за 1 {trip['dest_currency']} (например 12.5):",
         reply_markup=back_to_main_markup(),
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "menu_deletetrip")
 def cb_menu_deletetrip(c):
     bot.answer_callback_query(c.id)
     user_id = c.from_user.id
     trips = db.get_user_trips(user_id)
     if not trips:
-        bot.send_message(
+        send_message(
             c.message.chat.id,
             "Нет путешествий для удаления.",
             reply_markup=back_to_main_markup(),
         )
         return
-    bot.send_message(
+    send_message(
         c.message.chat.id,
         "Выберите путешествие для удаления (вместе с ним удалятся все расходы):",
         reply_markup=trips_list_markup(trips, "del_"),
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("del_confirm_"))
 def cb_del_confirm(c):
     bot.answer_callback_query(c.id)
     try:
@@ -397,19 +621,17 @@ def cb_del_confirm(c):
     except ValueError:
         return
     user_id = c.from_user.id
-    if not db.delete_trip(trip_id, user_id):
-        bot.send_message(c.message.chat.id, "Путешествие не найдено или уже удалено.", reply_markup=back_to_main_markup())
+    if not trip_cache.delete_trip(trip_id, user_id):
+        send_message(c.message.chat.id, "Путешествие не найдено или уже удалено.", reply_markup=back_to_main_markup())
         return
-    bot.send_message(c.message.chat.id, "Путешествие удалено.", reply_markup=back_to_main_markup())
+    send_message(c.message.chat.id, "Путешествие удалено.", reply_markup=back_to_main_markup())
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "del_cancel")
 def cb_del_cancel(c):
     bot.answer_callback_query(c.id)
-    send_main_menu(c.message.chat.id, "Удаление отменено.")
+    show_main_menu_in_place(c, "Удаление отменено.")
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("del_") and c.data != "del_cancel" and not c.data.startswith("del_confirm_"))
 def cb_del_choose(c):
     """Показать подтверждение удаления выбранной поездки."""
     bot.answer_callback_query(c.id)
@@ -418,50 +640,51 @@ def cb_del_choose(c):
     except ValueError:
         return
     user_id = c.from_user.id
-    trip = db.get_trip(trip_id, user_id)
+    trip = trip_cache.get_trip(trip_id, user_id)
     if not trip:
-        bot.send_message(c.message.chat.id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
+        send_message(c.message.chat.id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
         return
-    bot.send_message(
+    send_message(
         c.message.chat.id,
         f"Удалить путешествие «{trip['name']}» ({trip['dest_currency']})? Все расходы по этой поездке будут удалены.",
         reply_markup=trip_confirm_delete_markup(trip_id),
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "newtrip_fetch_rate")
 def cb_newtrip_fetch_rate(c):
     """Получить курс из API по нажатию кнопки (не при вводе страны — экономия лимита)."""
     bot.answer_callback_query(c.id)
     user_id = c.from_user.id
-    st = db.get_user_state(user_id)
+    st = state.get_user_state(user_id)
     if not st or st["state"] != "newtrip_choose_rate_source" or not st["state_data"]:
-        bot.send_message(c.message.chat.id, "Сессия устарела. Начните создание поездки заново.", reply_markup=main_menu_markup())
+        send_message(c.message.chat.id, "Сессия устарела. Начните создание поездки заново.", reply_markup=main_menu_markup())
         return
     parts = st["state_data"].split("|", 2)
     if len(parts) < 2:
-        db.clear_state(user_id)
+        state.clear_state(user_id)
         send_main_menu(c.message.chat.id)
         return
     home_currency, cur, country = parts[0], parts[1], (parts[2].strip() if len(parts) > 2 else cur)
-    result = convert(ACCESS_KEY, home_currency, cur, 1.0)
+    result = api.convert_from_table(home_currency, cur, 1.0)
     if not result.get("success"):
-        db.set_user_state(user_id, "newtrip_manual_rate", f"{home_currency}|{cur}|{country}")
+        state.set_user_state(user_id, "newtrip_manual_rate", f"{home_currency}|{cur}|{country}")
         # Никогда не показываем сырой текст ошибки API пользователю — только короткое сообщение.
         info = (result.get("info") or "").lower()
         is_limit = any(w in info for w in ("limit", "rate", "exceeded", "limitation", "maximum"))
         msg = "Превышен лимит запросов к сервису курсов. Введите курс вручную (например по обменнику)." if is_limit else "Сервис курсов временно недоступен. Введите курс вручную."
-        bot.send_message(
+        send_message(
             c.message.chat.id,
             f"{msg}\n\nСколько {cur} за 1 {home_currency}? (одно число)",
         )
         return
     api_dest_per_home = result["result"]
     rate = 1.0 / api_dest_per_home
-    db.set_user_state(user_id, "newtrip_confirm_rate", f"{home_currency}|{cur}|{rate}|{country}")
-    bot.send_message(
+    state.set_user_state(user_id, "newtrip_confirm_rate", f"{home_currency}|{cur}|{rate}|{country}")
+    # Сервис курсов недоступен, но есть курс, полученный в последний час
+    stale_note = "\n(Сервис курсов сейчас недоступен — показан последний полученный курс.)" if result.get("stale") else ""
+    send_message(
         c.message.chat.id,
-        f"Текущий курс: 1 {cur} = {rate:.4f} {home_currency} (1 {home_currency} = {api_dest_per_home:.4f} {cur}).\n\nВас устраивает?",
+        f"Текущий курс: 1 {cur} = {rate:.4f} {home_currency} (1 {home_currency} = {api_dest_per_home:.4f} {cur}).{stale_note}\n\nВас устраивает?",
         reply_markup=types.InlineKeyboardMarkup(row_width=2).add(
             types.InlineKeyboardButton("Да", callback_data="newtrip_rate_ok"),
             types.InlineKeyboardButton("Нет, ввести вручную", callback_data="newtrip_rate_manual"),
@@ -469,174 +692,236 @@ def cb_newtrip_fetch_rate(c):
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "newtrip_manual_rate_now")
 def cb_newtrip_manual_rate_now(c):
     """Переход к ручному вводу курса без вызова API."""
     bot.answer_callback_query(c.id)
     user_id = c.from_user.id
-    st = db.get_user_state(user_id)
+    st = state.get_user_state(user_id)
     if not st or st["state"] != "newtrip_choose_rate_source" or not st["state_data"]:
-        bot.send_message(c.message.chat.id, "Сессия устарела. Начните заново.", reply_markup=main_menu_markup())
+        send_message(c.message.chat.id, "Сессия устарела. Начните заново.", reply_markup=main_menu_markup())
         return
     parts = st["state_data"].split("|", 2)
     if len(parts) < 2:
-        db.clear_state(user_id)
+        state.clear_state(user_id)
         send_main_menu(c.message.chat.id)
         return
     home_cur, dest_cur = parts[0], parts[1]
     country = parts[2].strip() if len(parts) > 2 else dest_cur
-    db.set_user_state(user_id, "newtrip_manual_rate", f"{home_cur}|{dest_cur}|{country}")
-    bot.send_message(
+    state.set_user_state(user_id, "newtrip_manual_rate", f"{home_cur}|{dest_cur}|{country}")
+    send_message(
         c.message.chat.id,
         f"Введите курс: сколько {dest_cur} за 1 {home_cur}? (одно число, например 12.8)",
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "newtrip_rate_ok")
 def cb_newtrip_rate_ok(c):
     bot.answer_callback_query(c.id)
     user_id = c.from_user.id
-    st = db.get_user_state(user_id)
+    st = state.get_user_state(user_id)
     if not st or st["state"] != "newtrip_confirm_rate" or not st["state_data"]:
-        bot.send_message(c.message.chat.id, "Сессия устарела. Начните создание поездки заново.", reply_markup=main_menu_markup())
+        send_message(c.message.chat.id, "Сессия устарела. Начните создание поездки заново.", reply_markup=main_menu_markup())
         return
     parts = st["state_data"].split("|", 3)
     if len(parts) < 3:
-        db.clear_state(user_id)
+        state.clear_state(user_id)
         send_main_menu(c.message.chat.id, "Ошибка данных. Создайте поездку заново.")
         return
     home_cur, dest_cur, rate = parts[0], parts[1], parts[2]
     name = parts[3].strip() if len(parts) > 3 and parts[3] else dest_cur
-    db.set_user_state(user_id, "newtrip_initial_sum", f"{home_cur}|{dest_cur}|{rate}|{name}")
-    bot.send_message(
+    state.set_user_state(user_id, "newtrip_initial_sum", f"{home_cur}|{dest_cur}|{rate}|{name}")
+    send_message(
         c.message.chat.id,
         f"Курс принят. Введите начальную сумму в домашней валюте ({home_cur}) — она будет конвертирована в {dest_cur} и станет стартовым балансом.",
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "newtrip_rate_manual")
 def cb_newtrip_rate_manual(c):
     bot.answer_callback_query(c.id)
     user_id = c.from_user.id
-    st = db.get_user_state(user_id)
+    st = state.get_user_state(user_id)
     if not st or st["state"] != "newtrip_confirm_rate" or not st["state_data"]:
-        bot.send_message(c.message.chat.id, "Сессия устарела. Начните заново.", reply_markup=main_menu_markup())
+        send_message(c.message.chat.id, "Сессия устарела. Начните заново.", reply_markup=main_menu_markup())
         return
     parts = st["state_data"].split("|", 3)
     if len(parts) < 2:
-        db.clear_state(user_id)
+        state.clear_state(user_id)
         send_main_menu(c.message.chat.id)
         return
     home_cur, dest_cur = parts[0], parts[1]
     name = parts[3].strip() if len(parts) > 3 and parts[3] else dest_cur
-    db.set_user_state(user_id, "newtrip_manual_rate", f"{home_cur}|{dest_cur}|{name}")
-    bot.send_message(
+    state.set_user_state(user_id, "newtrip_manual_rate", f"{home_cur}|{dest_cur}|{name}")
+    send_message(
         c.message.chat.id,
         f"Введите курс вручную: сколько {dest_cur} за 1 {home_cur}? (одно число, например 12.8)",
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "expense_no")
 def cb_expense_no(c):
     bot.answer_callback_query(c.id)
-    bot.send_message(c.message.chat.id, "Расход не учтён.", reply_markup=back_to_main_markup())
-
-
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("expense_yes_"))
-def cb_expense_yes(c):
-    bot.answer_callback_query(c.id)
-    user_id = c.from_user.id
-    # expense_yes_<amount_dest>_<amount_home> — trip_id нужен из активного
-    trip_id = db.get_active_trip_id(user_id)
-    if not trip_id:
-        bot.send_message(c.message.chat.id, "Нет активного путешествия.")
-        return
-    parts = c.data.replace("expense_yes_", "").split("_")
-    if len(parts) < 2:
-        bot.send_message(c.message.chat.id, "Ошибка данных.")
-        return
-    try:
-        amount_dest = float(parts[0])
-        amount_home = float(parts[1])
-    except ValueError:
-        bot.send_message(c.message.chat.id, "Неверный формат суммы.")
-        return
-    ok = db.add_expense(trip_id, user_id, amount_dest, amount_home)
-    if not ok:
-        bot.send_message(
-            c.message.chat.id,
-            "Не удалось учесть расход (возможно, недостаточно средств на балансе).",
-            reply_markup=back_to_main_markup(),
-        )
-        return
-    trip = db.get_trip(trip_id, user_id)
-    bot.send_message(
-        c.message.chat.id,
-        f"Расход учтён. {db.format_balance(trip)}",
-        reply_markup=back_to_main_markup(),
-    )
+    send_message(c.message.chat.id, "Расход не учтён.", reply_markup=back_to_main_markup())
 
 
 # --- Yes/No для расхода: нужно передать trip_id в callback (т.к. пользователь может переключить поездку)
-# Переделаем: в callback храним trip_id, amount_dest, amount_home (через разделитель, без подчёркивания в числах)
-def expense_confirm_markup(trip_id: int, amount_dest: float, amount_home: float):
-    # Используем букву e и целые числа * 100 чтобы избежать точки
-    a_d = int(round(amount_dest * 100))
-    a_h = int(round(amount_home * 100))
+# Суммы в callback_data не кладём (лимит 64 байта, округление до копеек): расход ждёт
+# подтверждения в памяти, а в кнопке — только его короткий id.
+_PENDING_EXPENSE_TTL = 24 * 3600
+_PENDING_EXPENSE_MAXSIZE = 10000
+_pending_expenses: dict = {}  # pid -> (trip_id, user_id, amount_dest, amount_home, created_at)
+_pending_lock = threading.Lock()
+
+
+def create_pending_expense(trip_id: int, user_id: int, amount_dest: float, amount_home: float) -> str:
+    """Запоминает расход до нажатия «Да»; возвращает id для callback_data."""
+    # Случайный id, чтобы кнопки, отправленные до перезапуска бота, не указали на чужой расход
+    pid = secrets.token_hex(6)
+    _put_pending_expense(pid, (trip_id, user_id, amount_dest, amount_home, time.time()))
+    return pid
+
+
+def _put_pending_expense(pid: str, entry: tuple):
+    with _pending_lock:
+        # Записи добавляются по порядку времени — старые лежат в начале словаря.
+        # Сначала убираем истёкшие, затем при переполнении вытесняем самые давние
+        while _pending_expenses:
+            oldest = next(iter(_pending_expenses))
+            if (entry[4] - _pending_expenses[oldest][4] < _PENDING_EXPENSE_TTL
+                    and len(_pending_expenses) < _PENDING_EXPENSE_MAXSIZE):
+                break
+            del _pending_expenses[oldest]
+        _pending_expenses[pid] = entry
+
+
+def pop_pending_expense(pid: str, user_id: int):
+    """Забирает ожидающий расход пользователя: (trip_id, amount_dest, amount_home) или None."""
+    with _pending_lock:
+        entry = _pending_expenses.get(pid)
+        if entry is None or entry[1] != user_id:
+            return None
+        del _pending_expenses[pid]
+    if time.time() - entry[4] >= _PENDING_EXPENSE_TTL:
+        return None
+    return entry[0], entry[2], entry[3]
+
+
+def restore_pending_expense(pid: str, user_id: int, pending: tuple):
+    """Возвращает забранный расход, если записать его не удалось: кнопка «Да» снова работает."""
+    trip_id, amount_dest, amount_home = pending
+    # Новое время — чтобы словарь оставался упорядоченным по нему
+    _put_pending_expense(pid, (trip_id, user_id, amount_dest, amount_home, time.time()))
+
+
+def expense_confirm_markup(pid: str):
     return types.InlineKeyboardMarkup(row_width=2).add(
-        types.InlineKeyboardButton("✅ Да", callback_data=f"ex_{trip_id}_{a_d}_{a_h}"),
+        types.InlineKeyboardButton("✅ Да", callback_data=f"ex_{pid}"),
         types.InlineKeyboardButton("❌ Нет", callback_data="expense_no"),
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("ex_"))
 def cb_expense_confirm(c):
     bot.answer_callback_query(c.id)
     user_id = c.from_user.id
     parts = c.data.split("_")
-    if len(parts) != 4:
-        bot.send_message(c.message.chat.id, "Ошибка данных.")
+    pending = None
+    if len(parts) == 2:
+        pending = pop_pending_expense(parts[1], user_id)
+        if pending is None:
+            send_message(
+                c.message.chat.id,
+                "Запрос устарел или уже обработан. Введите сумму расхода ещё раз.",
+                reply_markup=back_to_main_markup(),
+            )
+            return
+        trip_id, amount_dest, amount_home = pending
+    elif len(parts) == 4:
+        # Старый формат кнопок: ex_<trip_id>_<amount_dest*100>_<amount_home*100>
+        try:
+            trip_id = int(parts[1])
+            amount_dest = int(parts[2]) / 100.0
+            amount_home = int(parts[3]) / 100.0
+        except (ValueError, IndexError):
+            send_message(c.message.chat.id, "Неверный формат.")
+            return
+    else:
+        send_message(c.message.chat.id, "Ошибка данных.")
         return
+    ok = False
     try:
-        trip_id = int(parts[1])
-        amount_dest = int(parts[2]) / 100.0
-        amount_home = int(parts[3]) / 100.0
-    except (ValueError, IndexError):
-        bot.send_message(c.message.chat.id, "Неверный формат.")
-        return
-    ok = db.add_expense(trip_id, user_id, amount_dest, amount_home)
+        ok = trip_cache.add_expense(trip_id, user_id, amount_dest, amount_home)
+    finally:
+        if not ok and pending is not None:
+            restore_pending_expense(parts[1], user_id, pending)
     if not ok:
-        bot.send_message(
+        send_message(
             c.message.chat.id,
             "Не удалось учесть расход (недостаточно средств или неверная поездка).",
             reply_markup=back_to_main_markup(),
         )
         return
-    trip = db.get_trip(trip_id, user_id)
-    bot.send_message(
+    trip = trip_cache.get_trip(trip_id, user_id)
+    send_message(
         c.message.chat.id,
         f"Расход учтён. {db.format_balance(trip)}",
         reply_markup=back_to_main_markup(),
     )
 
 
-# Исправление: при показе "Учесть как расход?" использовать ex_ с trip_id
-# (уже добавлен expense_confirm_markup и cb_expense_confirm)
+# --- Диспетчер callback-кнопок: один обработчик вместо фильтра на каждую кнопку ---
+CB_HANDLERS = {
+    "menu_main": cb_menu_main,
+    "menu_back": cb_menu_back,
+    "menu_newtrip": cb_menu_newtrip,
+    "menu_trips": cb_menu_trips,
+    "menu_balance": cb_menu_balance,
+    "menu_history": cb_menu_history,
+    "menu_setrate": cb_menu_setrate,
+    "menu_deletetrip": cb_menu_deletetrip,
+    "del_cancel": cb_del_cancel,
+    "newtrip_fetch_rate": cb_newtrip_fetch_rate,
+    "newtrip_manual_rate_now": cb_newtrip_manual_rate_now,
+    "newtrip_rate_ok": cb_newtrip_rate_ok,
+    "newtrip_rate_manual": cb_newtrip_rate_manual,
+    "expense_no": cb_expense_no,
+}
+
+# Префиксы с параметром; более длинный префикс проверяется раньше (del_confirm_ до del_)
+CB_PREFIXES = sorted(
+    [
+        ("switch_", cb_switch_trip),
+        ("setrate_", cb_setrate_choose),
+        ("del_confirm_", cb_del_confirm),
+        ("del_", cb_del_choose),
+        ("ex_", cb_expense_confirm),
+    ],
+    key=lambda item: len(item[0]),
+    reverse=True,
+)
+
+
+@bot.callback_query_handler(func=lambda c: True)
+def cb_dispatch(c):
+    data = c.data or ""
+    handler = CB_HANDLERS.get(data)
+    if handler is None:
+        handler = next((h for prefix, h in CB_PREFIXES if data.startswith(prefix)), None)
+    if handler is not None:
+        handler(c)
 
 
 # --- Сообщения и команды ---
 @bot.message_handler(commands=["start"])
 def cmd_start(message):
     db.ensure_user(message.from_user.id)
-    db.clear_state(message.from_user.id)
-    bot.send_message(
+    # Строку user_state в БД сбрасываем как раньше: в ней хранится и активное путешествие
+    trip_cache.clear_state(message.from_user.id)
+    state.clear_state(message.from_user.id)
+    send_message(
         message.chat.id,
         "Привет! Это мини-кошелёк для путешественника. Можно создать путешествие (страна отправления → страна назначения), "
         "задать курс и начальный баланс, а затем записывать расходы в валюте поездки.\n\n"
         "Используйте кнопки меню ниже для быстрого доступа или выберите действие:",
         reply_markup=reply_keyboard_menu(),
     )
-    bot.send_message(
+    send_message(
         message.chat.id,
         main_menu_text(),
         reply_markup=main_menu_markup(),
@@ -653,9 +938,9 @@ def cmd_switch(message):
     user_id = message.from_user.id
     trips = db.get_user_trips(user_id)
     if not trips:
-        bot.send_message(message.chat.id, "У вас пока нет путешествий. Создайте: /newtrip или кнопка «Создать новое путешествие».", reply_markup=main_menu_markup())
+        send_message(message.chat.id, "У вас пока нет путешествий. Создайте: /newtrip или кнопка «Создать новое путешествие».", reply_markup=main_menu_markup())
         return
-    bot.send_message(
+    send_message(
         message.chat.id,
         "Выберите путешествие:",
         reply_markup=trips_list_markup(trips, "switch_"),
@@ -665,34 +950,33 @@ def cmd_switch(message):
 @bot.message_handler(commands=["balance"])
 def cmd_balance(message):
     user_id = message.from_user.id
-    trip_id = db.get_active_trip_id(user_id)
+    trip_id = trip_cache.get_active_trip_id(user_id)
     if not trip_id:
-        bot.send_message(message.chat.id, "Нет активного путешествия. /switch — выбрать поездку.", reply_markup=main_menu_markup())
+        send_message(message.chat.id, "Нет активного путешествия. /switch — выбрать поездку.", reply_markup=main_menu_markup())
         return
-    trip = db.get_trip(trip_id, user_id)
+    trip = trip_cache.get_trip(trip_id, user_id)
     if not trip:
-        bot.send_message(message.chat.id, "Путешествие не найдено.")
+        send_message(message.chat.id, "Путешествие не найдено.")
         return
-    bot.send_message(message.chat.id, f"«{trip['name']}»\n{db.format_balance(trip)}", reply_markup=back_to_main_markup())
+    send_message(message.chat.id, f"«{trip['name']}»\n{db.format_balance(trip)}", reply_markup=back_to_main_markup())
 
 
 @bot.message_handler(commands=["history"])
 def cmd_history(message):
     user_id = message.from_user.id
-    trip_id = db.get_active_trip_id(user_id)
+    trip_id = trip_cache.get_active_trip_id(user_id)
     if not trip_id:
-        bot.send_message(message.chat.id, "Нет активного путешествия. /switch — выбрать поездку.", reply_markup=main_menu_markup())
+        send_message(message.chat.id, "Нет активного путешествия. /switch — выбрать поездку.", reply_markup=main_menu_markup())
         return
-    trip = db.get_trip(trip_id, user_id)
+    trip = trip_cache.get_trip(trip_id, user_id)
     if not trip:
-        bot.send_message(message.chat.id, "Путешествие не найдено.")
+        send_message(message.chat.id, "Путешествие не найдено.")
         return
     expenses = db.get_expenses(trip_id, user_id)
     if not expenses:
-        bot.send_message(message.chat.id, f"По «{trip['name']}» расходов пока нет.", reply_markup=back_to_main_markup())
+        send_message(message.chat.id, f"По «{trip['name']}» расходов пока нет.", reply_markup=back_to_main_markup())
         return
-    lines = [f"«{trip['name']}»", ""] + [db.format_expense_line(e, trip["dest_currency"], trip["home_currency"]) for e in expenses]
-    bot.send_message(message.chat.id, "\n".join(lines), reply_markup=back_to_main_markup())
+    send_history(message.chat.id, f"«{trip['name']}»", trip, expenses)
 
 
 @bot.message_handler(commands=["setrate"])
@@ -700,9 +984,9 @@ def cmd_setrate(message):
     user_id = message.from_user.id
     trips = db.get_user_trips(user_id)
     if not trips:
-        bot.send_message(message.chat.id, "Нет путешествий. /newtrip — создать.", reply_markup=main_menu_markup())
+        send_message(message.chat.id, "Нет путешествий. /newtrip — создать.", reply_markup=main_menu_markup())
         return
-    bot.send_message(
+    send_message(
         message.chat.id,
         "Выберите путешествие для смены курса:",
         reply_markup=trips_list_markup(trips, "setrate_"),
@@ -714,159 +998,125 @@ def cmd_deletetrip(message):
     user_id = message.from_user.id
     trips = db.get_user_trips(user_id)
     if not trips:
-        bot.send_message(message.chat.id, "Нет путешествий для удаления.", reply_markup=main_menu_markup())
+        send_message(message.chat.id, "Нет путешествий для удаления.", reply_markup=main_menu_markup())
         return
-    bot.send_message(
+    send_message(
         message.chat.id,
         "Выберите путешествие для удаления (вместе с ним удалятся все расходы):",
         reply_markup=trips_list_markup(trips, "del_"),
     )
 
 
-@bot.message_handler(func=lambda m: True)
-def handle_message(message):
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-    st = db.get_user_state(user_id)
-    state = st["state"] if st else ""
-    state_data = (st["state_data"] or "") if st else ""
+# --- Кнопки быстрого меню (reply keyboard) ---
+def menu_trips(chat_id: int, user_id: int):
+    trips = db.get_user_trips(user_id)
+    if not trips:
+        send_message(chat_id, "У вас пока нет путешествий. Создайте первое — кнопка «Создать путешествие».", reply_markup=back_to_main_markup())
+        return
+    lines = ["Выберите путешествие:"]
+    active_id = trip_cache.get_active_trip_id(user_id)
+    for t in trips:
+        mark = " ✓" if t["id"] == active_id else ""
+        lines.append(f"• {t['name']} ({t['dest_currency']}){mark}")
+    send_message(chat_id, "\n".join(lines), reply_markup=trips_list_markup(trips, "switch_"))
 
-    # FSM: создание поездки
-    if state == "newtrip_country_from":
-        handle_newtrip_country_from(message, user_id)
+
+def menu_balance(chat_id: int, user_id: int):
+    trip_id = trip_cache.get_active_trip_id(user_id)
+    if not trip_id:
+        send_message(chat_id, "Нет активного путешествия. Выберите или создайте в «Мои путешествия».", reply_markup=back_to_main_markup())
         return
-    if state == "newtrip_country_to":
-        handle_newtrip_country_to(message, user_id, state_data)
+    trip = trip_cache.get_trip(trip_id, user_id)
+    if trip:
+        send_message(chat_id, f"«{trip['name']}»\n{db.format_balance(trip)}", reply_markup=back_to_main_markup())
+    else:
+        send_message(chat_id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
+
+
+def menu_history(chat_id: int, user_id: int):
+    trip_id = trip_cache.get_active_trip_id(user_id)
+    if not trip_id:
+        send_message(chat_id, "Нет активного путешествия. Выберите поездку в «Мои путешествия».", reply_markup=back_to_main_markup())
         return
-    if state == "newtrip_initial_sum":
-        handle_newtrip_initial_sum(message, user_id, state_data)
+    trip = trip_cache.get_trip(trip_id, user_id)
+    if not trip:
+        send_message(chat_id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
         return
-    if state == "newtrip_manual_rate":
-        # Ввод курса вручную: сколько валюты назначения за 1 домашнюю -> храним (домашняя за 1 назначения) = 1/ввод
-        if not is_number_message(message.text) or parse_amount(message.text) <= 0:
-            bot.send_message(chat_id, "Введите положительное число — курс (сколько валюты назначения за 1 единицу домашней).")
-            return
-        manual_dest_per_home = parse_amount(message.text)
-        rate = 1.0 / manual_dest_per_home
-        parts = state_data.split("|", 2)
-        if len(parts) < 2:
-            db.clear_state(user_id)
-            send_main_menu(chat_id, "Ошибка. Начните создание заново.")
-            return
-        home_cur, dest_cur = parts[0], parts[1]
-        name = parts[2].strip() if len(parts) > 2 and parts[2] else dest_cur
-        db.set_user_state(user_id, "newtrip_initial_sum", f"{home_cur}|{dest_cur}|{rate}|{name}")
-        bot.send_message(chat_id, f"Курс принят: 1 {home_cur} = {rate} {dest_cur}. Введите начальную сумму в {home_cur}:")
-        return
-    if state == "setrate_trip":
-        if not is_number_message(message.text) or parse_amount(message.text) <= 0:
-            bot.send_message(chat_id, "Введите положительное число — новый курс.")
-            return
-        try:
-            trip_id = int(state_data)
-        except ValueError:
-            db.clear_state(user_id)
-            send_main_menu(chat_id)
-            return
-        trip = db.get_trip(trip_id, user_id)
-        if not trip:
-            db.clear_state(user_id)
-            bot.send_message(chat_id, "Путешествие не найдено.", reply_markup=main_menu_markup())
-            return
-        new_rate = parse_amount(message.text)
-        db.update_trip_rate(trip_id, user_id, new_rate)
-        db.clear_state(user_id)
-        trip = db.get_trip(trip_id, user_id)
-        bot.send_message(chat_id, f"Курс обновлён: 1 {trip['home_currency']} = {trip['rate']} {trip['dest_currency']}.", reply_markup=main_menu_markup())
+    expenses = db.get_expenses(trip_id, user_id)
+    if not expenses:
+        send_message(chat_id, f"По «{trip['name']}» расходов пока нет.", reply_markup=back_to_main_markup())
         return
+    send_history(chat_id, f"История: «{trip['name']}»", trip, expenses)
 
-    # Нажатие кнопок быстрого меню (reply keyboard)
-    text = (message.text or "").strip()
-    if text == MENU_BTN_NEWTRIP:
-        start_new_trip_flow(chat_id, user_id)
+
+def menu_setrate(chat_id: int, user_id: int):
+    trips = db.get_user_trips(user_id)
+    if not trips:
+        send_message(chat_id, "Нет путешествий. Создайте поездку в «Создать путешествие».", reply_markup=back_to_main_markup())
         return
-    if text == MENU_BTN_TRIPS:
-        trips = db.get_user_trips(user_id)
-        if not trips:
-            bot.send_message(chat_id, "У вас пока нет путешествий. Создайте первое — кнопка «Создать путешествие».", reply_markup=back_to_main_markup())
-        else:
-            lines = ["Выберите путешествие:"]
-            active_id = db.get_active_trip_id(user_id)
-            for t in trips:
-                mark = " ✓" if t["id"] == active_id else ""
-                lines.append(f"• {t['name']} ({t['dest_currency']}){mark}")
-            bot.send_message(chat_id, "\n".join(lines), reply_markup=trips_list_markup(trips, "switch_"))
-        return
-    if text == MENU_BTN_BALANCE:
-        trip_id = db.get_active_trip_id(user_id)
-        if not trip_id:
-            bot.send_message(chat_id, "Нет активного путешествия. Выберите или создайте в «Мои путешествия».", reply_markup=back_to_main_markup())
-        else:
-            trip = db.get_trip(trip_id, user_id)
-            if trip:
-                bot.send_message(chat_id, f"«{trip['name']}»\n{db.format_balance(trip)}", reply_markup=back_to_main_markup())
-            else:
-                bot.send_message(chat_id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
-        return
-    if text == MENU_BTN_HISTORY:
-        trip_id = db.get_active_trip_id(user_id)
-        if not trip_id:
-            bot.send_message(chat_id, "Нет активного путешествия. Выберите поездку в «Мои путешествия».", reply_markup=back_to_main_markup())
-        else:
-            trip = db.get_trip(trip_id, user_id)
-            if not trip:
-                bot.send_message(chat_id, "Путешествие не найдено.", reply_markup=back_to_main_markup())
-            else:
-                expenses = db.get_expenses(trip_id, user_id)
-                if not expenses:
-                    bot.send_message(chat_id, f"По «{trip['name']}» расходов пока нет.", reply_markup=back_to_main_markup())
-                else:
-                    lines = [f"История: «{trip['name']}»", ""] + [db.format_expense_line(e, trip["dest_currency"], trip["home_currency"]) for e in expenses]
-                    bot.send_message(chat_id, "\n".join(lines), reply_markup=back_to_main_markup())
-        return
-    if text == MENU_BTN_SETRATE:
-        trips = db.get_user_trips(user_id)
-        if not trips:
-            bot.send_message(chat_id, "Нет путешествий. Создайте поездку в «Создать путешествие».", reply_markup=back_to_main_markup())
-        else:
-            bot.send_message(chat_id, "Выберите путешествие для смены курса:", reply_markup=trips_list_markup(trips, "setrate_"))
+    send_message(chat_id, "Выберите путешествие для смены курса:", reply_markup=trips_list_markup(trips, "setrate_"))
+
+
+def menu_deletetrip(chat_id: int, user_id: int):
+    trips = db.get_user_trips(user_id)
+    if not trips:
+        send_message(chat_id, "Нет путешествий для удаления.", reply_markup=back_to_main_markup())
         return
-    if text == MENU_BTN_DELETETRIP:
-        trips = db.get_user_trips(user_id)
-        if not trips:
-            bot.send_message(chat_id, "Нет путешествий для удаления.", reply_markup=back_to_main_markup())
-        else:
-            bot.send_message(
-                chat_id,
-                "Выберите путешествие для удаления (вместе с ним удалятся все расходы):",
-                reply_markup=trips_list_markup(trips, "del_"),
-            )
+    send_message(
+        chat_id,
+        "Выберите путешествие для удаления (вместе с ним удалятся все расходы):",
+        reply_markup=trips_list_markup(trips, "del_"),
+    )
+
+
+# Текст кнопки -> обработчик(chat_id, user_id)
+_MENU_HANDLERS = {
+    MENU_BTN_NEWTRIP: start_new_trip_flow,
+    MENU_BTN_TRIPS: menu_trips,
+    MENU_BTN_BALANCE: menu_balance,
+    MENU_BTN_HISTORY: menu_history,
+    MENU_BTN_SETRATE: menu_setrate,
+    MENU_BTN_DELETETRIP: menu_deletetrip,
+}
+
+
+def handle_stateless_message(message, user_id: int, state_data: str):
+    """Сообщение вне сценария FSM: кнопка меню, сумма расхода или подсказка."""
+    chat_id = message.chat.id
+
+    # Нажатие кнопок быстрого меню (reply keyboard)
+    text = (message.text or "").strip()
+    menu_handler = _MENU_HANDLERS.get(text)
+    if menu_handler is not None:
+        menu_handler(chat_id, user_id)
         return
 
     # Число без состояния = расход в валюте активного путешествия
-    if is_number_message(message.text):
-        trip_id = db.get_active_trip_id(user_id)
+    amount_dest = try_parse_amount(message.text)
+    if amount_dest is not None:
+        trip_id = trip_cache.get_active_trip_id(user_id)
         if not trip_id:
-            bot.send_message(
+            send_message(
                 chat_id,
                 "Сначала выберите или создайте путешествие (меню «Мои путешествия» или /switch).",
                 reply_markup=main_menu_markup(),
             )
             return
-        trip = db.get_trip(trip_id, user_id)
+        trip = trip_cache.get_trip(trip_id, user_id)
         if not trip:
-            bot.send_message(chat_id, "Путешествие не найдено.", reply_markup=main_menu_markup())
+            send_message(chat_id, "Путешествие не найдено.", reply_markup=main_menu_markup())
             return
-        amount_dest = parse_amount(message.text)
         if amount_dest <= 0:
-            bot.send_message(chat_id, "Введите положительную сумму расхода.")
+            send_message(chat_id, "Введите положительную сумму расхода.")
             return
         # Курс хранится как "домашняя за 1 валюту поездки". amount_home = amount_dest * rate
         amount_home = amount_dest * trip["rate"]
-        bot.send_message(
+        send_message(
             chat_id,
             f"{amount_dest:.2f} {trip['dest_currency']} = {amount_home:.2f} {trip['home_currency']}. Учесть как расход?",
-            reply_markup=expense_confirm_markup(trip_id, amount_dest, amount_home),
+            reply_markup=expense_confirm_markup(
+                create_pending_expense(trip_id, user_id, amount_dest, amount_home),
+            ),
         )
         return
 
@@ -874,10 +1124,65 @@ def handle_message(message):
     send_main_menu(chat_id, "Не понял. Введите число для записи расхода по активному путешествию или выберите действие в меню.")
 
 
+@bot.message_handler(func=lambda m: True)
+def handle_message(message):
+    user_id = message.from_user.id
+    st = state.get_user_state(user_id)
+    user_state = st["state"] if st else ""
+    state_data = (st["state_data"] or "") if st else ""
+    # FSM: создание поездки и смена курса; без состояния — меню и расходы
+    _STATE_HANDLERS.get(user_state, handle_stateless_message)(message, user_id, state_data)
+
+
+# --- Webhook ---
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Принимает обновления от Telegram (POST с JSON) и передаёт их обработчикам бота."""
+
+    def do_POST(self):
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token") or ""
+        if not hmac.compare_digest(token.encode("utf-8"), WEBHOOK_SECRET.encode("utf-8")):
+            self.send_response(403)
+            self.end_headers()
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8")
+        # Отвечаем сразу: сами обработчики выполняются в пуле потоков чатов
+        self.send_response(200)
+        self.end_headers()
+        try:
+            bot.process_new_updates([types.Update.de_json(body)])
+        except Exception:
+            logger.exception("Не удалось обработать обновление из webhook")
+
+    def log_message(self, format, *args):
+        logger.debug("Webhook: " + format, *args)
+
+
+def run_webhook():
+    if not config.get("TELEGRAM_WEBHOOK_SECRET"):
+        logger.warning("TELEGRAM_WEBHOOK_SECRET не задан — используется случайный секрет до перезапуска")
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, drop_pending_updates=True)
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookHandler)
+    logger.info("Webhook: %s (слушаем %s:%s)", WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
 def main():
     db.init_db()
     logger.info("Бот запущен")
-    bot.infinity_polling()
+    if WEBHOOK_URL:
+        run_webhook()
+        return
+    # getUpdates не работает, пока у бота установлен webhook
+    bot.remove_webhook()
+    # Long polling: Telegram держит запрос до POLLING_TIMEOUT сек., пока нет обновлений.
+    # timeout оставляем по умолчанию: это и таймаут подключения, а таймаут чтения telebot
+    # сам делает не меньше long_polling_timeout + 5.
+    # Обновления, накопившиеся пока бот был остановлен, пропускаем (в webhook — drop_pending_updates)
+    bot.infinity_polling(long_polling_timeout=POLLING_TIMEOUT, skip_pending=True)
 
 
 if __name__ == "__main__":
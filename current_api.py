@@ -4,6 +4,8 @@
 Используется ботом для конвертации и проверки валют.
 """
 
+from functools import lru_cache
+
 from api_client import get_config, convert, get_currencies_list, check_currencies_available
 
 # Маппинг: страна (название, по-русски или по-английски) -> код валюты (ISO 4217)
@@ -417,8 +419,13 @@ def country_to_currency(country: str) -> str | None:
     """Возвращает код валюты по названию страны или None, если не найдено."""
     if not country or not isinstance(country, str):
         return None
-    key = country.strip().lower()
-    return COUNTRY_TO_CURRENCY.get(key)
+    return _country_to_currency(country)
+
+
+@lru_cache(maxsize=2048)
+def _country_to_currency(country: str) -> str | None:
+    # Кэш по исходному вводу: повторный ввод той же строки не нормализуется заново
+    return COUNTRY_TO_CURRENCY.get(country.strip().lower())
 
 
 def get_rate_and_convert(access_key: str, from_cur: str, to_cur: str, amount: float):
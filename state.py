@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Состояние диалога (FSM) пользователей в памяти процесса.
+Состояние короткоживущее и не требует записи в SQLite на каждый шаг:
+функции повторяют интерфейс db.get_user_state / db.set_user_state / db.clear_state.
+При перезапуске бота незавершённые сценарии сбрасываются.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# user_id -> (state, state_data, время последнего обращения)
+_states: OrderedDict = OrderedDict()
+_lock = threading.Lock()
+_STATE_TTL = 6 * 3600
+_STATE_MAXSIZE = 10000
+
+
+def get_user_state(user_id: int):
+    """Возвращает dict с ключами state, state_data или None, если состояния нет."""
+    now = time.time()
+    with _lock:
+        entry = _states.get(user_id)
+        if entry is None:
+            return None
+        state, state_data, touched_at = entry
+        if now - touched_at >= _STATE_TTL:
+            del _states[user_id]
+            return None
+        _states[user_id] = (state, state_data, now)
+        _states.move_to_end(user_id)
+    return {"state": state, "state_data": state_data}
+
+
+def set_user_state(user_id: int, state: str, state_data=None):
+    """Сохраняет состояние пользователя; при переполнении вытесняется самое давнее."""
+    with _lock:
+        _states[user_id] = (state, state_data, time.time())
+        _states.move_to_end(user_id)
+        while len(_states) > _STATE_MAXSIZE:
+            _states.popitem(last=False)
+
+
+def clear_state(user_id: int):
+    """Сбрасывает состояние пользователя."""
+    with _lock:
+        _states.pop(user_id, None)
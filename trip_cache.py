@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Кэш поездок в памяти поверх db: активное путешествие пользователя и строки trips.
+Бот читает их почти на каждое сообщение, а меняются они редко. Все изменения поездок
+идут через функции этого модуля и сразу сбрасывают затронутые записи; TTL 30 сек.
+ограничивает устаревание, если БД изменили в обход бота.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import db
+
+_CACHE_TTL = 30
+_CACHE_MAXSIZE = 4096
+
+# user_id -> (active_trip_id, время); (trip_id, user_id) -> (trip, время)
+_active_ids: OrderedDict = OrderedDict()
+_trips: OrderedDict = OrderedDict()
+_lock = threading.Lock()
+_MISSING = object()
+
+
+def _get(cache: OrderedDict, key):
+    with _lock:
+        entry = cache.get(key)
+        if entry is None:
+            return _MISSING
+        if time.monotonic() - entry[1] >= _CACHE_TTL:
+            del cache[key]
+            return _MISSING
+        cache.move_to_end(key)
+        return entry[0]
+
+
+def _put(cache: OrderedDict, key, value):
+    with _lock:
+        cache[key] = (value, time.monotonic())
+        cache.move_to_end(key)
+        while len(cache) > _CACHE_MAXSIZE:
+            cache.popitem(last=False)
+
+
+def _forget_active(user_id: int):
+    with _lock:
+        _active_ids.pop(user_id, None)
+
+
+def _forget_trip(trip_id: int, user_id: int):
+    with _lock:
+        _trips.pop((trip_id, user_id), None)
+
+
+def get_active_trip_id(user_id: int):
+    trip_id = _get(_active_ids, user_id)
+    if trip_id is _MISSING:
+        trip_id = db.get_active_trip_id(user_id)
+        _put(_active_ids, user_id, trip_id)
+    return trip_id
+
+
+def get_trip(trip_id: int, user_id: int):
+    trip = _get(_trips, (trip_id, user_id))
+    if trip is _MISSING:
+        trip = db.get_trip(trip_id, user_id)
+        # «Не найдено» не кэшируем: поездку могут тут же создать
+        if trip:
+            _put(_trips, (trip_id, user_id), trip)
+    return trip
+
+
+def set_active_trip(user_id: int, trip_id: int):
+    result = db.set_active_trip(user_id, trip_id)
+    _forget_active(user_id)
+    return result
+
+
+def create_trip(user_id: int, *args):
+    trip_id = db.create_trip(user_id, *args)
+    # Новая поездка может стать активной
+    _forget_active(user_id)
+    return trip_id
+
+
+def add_expense(trip_id: int, user_id: int, amount_dest: float, amount_home: float):
+    ok = db.add_expense(trip_id, user_id, amount_dest, amount_home)
+    _forget_trip(trip_id, user_id)
+    return ok
+
+
+def update_trip_rate(trip_id: int, user_id: int, rate: float):
+    result = db.update_trip_rate(trip_id, user_id, rate)
+    _forget_trip(trip_id, user_id)
+    return result
+
+
+def delete_trip(trip_id: int, user_id: int):
+    ok = db.delete_trip(trip_id, user_id)
+    _forget_trip(trip_id, user_id)
+    _forget_active(user_id)
+    return ok
+
+
+def clear_state(user_id: int):
+    """db.clear_state: строка user_state хранит и активное путешествие — сбрасываем его кэш."""
+    result = db.clear_state(user_id)
+    _forget_active(user_id)
+    return result